@@ -1,15 +1,542 @@
+import atexit
+import base64
+import hashlib
 import os
 import re
+import socket
+import subprocess
 import tempfile
-
-from flask import Flask, Blueprint, request, send_file, make_response, jsonify
-import markdown  # 用于预览时把 markdown 转为 HTML
-import pypandoc  # 用于导出 docx/pdf
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from flask import Flask, Blueprint, Response, request, jsonify
+from markdown_it import MarkdownIt  # 用于预览时把 markdown 转为 HTML
+from markdown_it.common.utils import escapeHtml, unescapeAll
+from mdit_py_plugins.dollarmath import dollarmath_plugin
+from mdit_py_plugins.texmath import texmath_plugin
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import TextLexer, get_lexer_by_name
+from pygments.util import ClassNotFound
+import pypandoc  # 用于 /convert 接口
+import requests  # 用于请求常驻的 pandoc server
 
 
 app = Flask(__name__)
 bp = Blueprint("doc_converter", __name__, url_prefix="/doc_converter/v1")
 
+# 预处理用到的正则在模块加载时编译一次，避免每个请求重复查找/编译
+# \[...\] 公式及其同一行内前后的空白；公式内容不跨越另一个 \[ 或 \]。
+# 只把未转义的 \[ \] 当作定界符，公式内的换行间距 \\[2pt] 不受影响；
+# 匹配只从一段空白的开头开始，避免在长串空格中每个位置重新尝试
+_RE_BLOCK_MATH = re.compile(
+    r"(?<![^\S\n])[^\S\n]*(?<!\\)\\\[((?:(?!(?<!\\)\\[\[\]]).)*?)(?<!\\)\\\][^\S\n]*", re.DOTALL
+)
+# \[1mm] => \vspace{1mm}
+_RE_VSPACE_1MM = re.compile(r"\\\[1mm\]")
+# \( \) => $ $，\[ \] => $$ $$，一次扫描完成四种替换
+_RE_MATH_DELIM = re.compile(r"\\[()\[\]]")
+_MATH_DELIM_MAP = {r"\(": "$", r"\)": "$", r"\[": "$$", r"\]": "$$"}
+# 矩阵、大括号、cases、aligned 等环境的改写
+# 互不依赖的改写合并为一次扫描，由回调按匹配到的分支决定替换内容
+_RE_VMATRIX = re.compile(r"\\begin\{([vV])matrix\}(.*?)\\end\{\1matrix\}", re.DOTALL)
+_RE_BRACE_SPACE = re.compile(r"\\left\\\{\s+|\s+\\right\\\}")
+_RE_CASES = re.compile(r"\\begin\{cases\}(.*?)\\end\{cases\}", re.DOTALL)
+_RE_ALIGNED = re.compile(
+    r"\\left\\\{\\begin\{aligned\}(?P<braced>.*?)\\end\{aligned\}\\right\."
+    r"|\\begin\{aligned\}(?P<plain>.*?)\\end\{aligned\}",
+    re.DOTALL,
+)
+_RE_ALIGN_MARK = re.compile(r"(^|\\\\)\s*&")
+# mermaid 代码块，由 mermaid_filter.lua 在 pandoc 内渲染
+_RE_MERMAID = re.compile(r"^\s*(```|~~~)\s*\{?\s*\.?(mermaid|sequence|flowchart)\b", re.MULTILINE)
+# Markdown 或 HTML 图片，需要由命令行 pandoc 读取文件或下载后嵌入 docx
+_RE_IMAGE = re.compile(r"!\[|<img\b", re.IGNORECASE)
+
+PREVIEW_CACHE_SIZE = 512
+# 预览 HTML 的总字节数上限：代码较多的文档渲染结果可达数 MB，只限制条数不足以限制内存
+PREVIEW_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+class LRUCache:
+    """
+    线程安全的简单 LRU 缓存。
+    值为 bytes 时可通过 maxbytes 限制所有值的总大小，超过上限的单个值不缓存。
+    """
+
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        return len(value) if self.maxbytes is not None else 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def put(self, key, value):
+        size = self._size(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(old)
+            self._data[key] = value
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self._bytes > self.maxbytes):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+
+def pad_block_math(md_text):
+    """
+    保证 \\[...\\] 公式的前后有空行，一次扫描完成：
+    独占一行的公式前后各加一个换行，嵌在文字中的公式则从文字中拆分出来。
+    """
+
+    def repl(m):
+        alone = (m.start() == 0 or md_text[m.start() - 1] == "\n") and (
+            m.end() == len(md_text) or md_text[m.end()] == "\n"
+        )
+        if alone:
+            return "\n\\[" + m.group(1) + "\\]\n"
+        return "\n\n\\[" + m.group(1) + "\\]\n\n"
+
+    return _RE_BLOCK_MATH.sub(repl, md_text)
+
+
+def strip_inline_math_spaces(text):
+    """
+    $ formula $ => $formula$，去除 $ 与行内公式之间的空格，$$...$$ 块级公式保持不变。
+
+    用 str.find 在 $ 之间跳转，线性时间完成，避免正则在大量 $ 时回溯。
+    """
+    parts = []
+    pos = 0
+    i = text.find("$")
+    while i != -1:
+        if text.startswith("$$", i):
+            # 跳过整个块级公式
+            end = text.find("$$", i + 2)
+            if end == -1:
+                # 没有闭合的 $$ 按普通文本处理，继续扫描后面的内容
+                i = text.find("$", i + 2)
+                continue
+            i = text.find("$", end + 2)
+            continue
+
+        j = text.find("$", i + 1)
+        if j == -1:
+            break
+        # 行内公式不跨行，且不能以 $$ 结束；否则把 j 当作新的起点
+        if text.startswith("$$", j) or text.find("\n", i + 1, j) != -1:
+            i = j
+            continue
+
+        content = text[i + 1 : j]
+        if content.startswith(" ") and content.endswith(" ") and content.strip(" "):
+            parts.append(text[pos : i + 1])
+            parts.append(content.strip(" "))
+            pos = j
+        i = text.find("$", j + 1)
+
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def content_digest(text):
+    """
+    计算文本的 blake2b 摘要，用作缓存键，避免把整篇 Markdown 存为键。
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# 预览结果缓存：实时预览会反复提交相同的内容
+_preview_cache = LRUCache(PREVIEW_CACHE_SIZE, PREVIEW_CACHE_MAX_BYTES)
+
+
+# HtmlFormatter 无状态，所有代码块共用一个实例
+_code_formatter = HtmlFormatter(cssclass="codehilite", wrapcode=True)
+
+
+@lru_cache(maxsize=64)
+def get_lexer(lang):
+    """
+    按语言名缓存 Pygments lexer，避免每个代码块都重新查找、构造。
+    """
+    if not lang:
+        return TextLexer()
+    try:
+        return get_lexer_by_name(lang)
+    except ClassNotFound:
+        return TextLexer()
+
+
+def highlight_code(code, lang):
+    """
+    用 Pygments 高亮代码，输出与 codehilite 扩展相同的 HTML 结构。
+    """
+    return highlight(code, get_lexer(lang), _code_formatter)
+
+
+def _render_code(self, tokens, idx, options, env):
+    info = unescapeAll(tokens[idx].info).strip()
+    lang = info.split(maxsplit=1)[0] if info else ""
+    return highlight_code(tokens[idx].content, lang)
+
+
+def _render_math_inline(self, tokens, idx, options, env):
+    return '<span class="arithmatex">\\(' + escapeHtml(tokens[idx].content) + "\\)</span>"
+
+
+def _render_math_block(self, tokens, idx, options, env):
+    return '<div class="arithmatex">\\[' + escapeHtml(tokens[idx].content) + "\\]</div>\n"
+
+
+# 预览使用 markdown-it-py 渲染：支持表格、换行转 <br>、$...$ 与 \(...\)、\[...\] 公式。
+# 公式输出与 pymdownx.arithmatex(generic) 一致，前端 MathJax 无需改动
+_markdown = (
+    MarkdownIt("commonmark", {"breaks": True, "html": True})
+    .enable("table")
+    .use(dollarmath_plugin, allow_space=False)
+    .use(texmath_plugin, delimiters="brackets")
+)
+for _rule in ("fence", "code_block"):
+    _markdown.add_render_rule(_rule, _render_code)
+_markdown.add_render_rule("math_inline", _render_math_inline)
+for _rule in ("math_block", "math_block_label", "math_block_eqno"):
+    _markdown.add_render_rule(_rule, _render_math_block)
+
+PANDOC_CHUNK_SIZE = 64 * 1024
+
+# 增加 +raw_tex+tex_math_double_backslash
+# 移除 --mathml，减少对LaTeX命令的干扰
+# Explicitly define input format with extensions
+PANDOC_INPUT_FORMAT = "markdown+raw_tex+tex_math_dollars+tex_math_double_backslash"
+
+PDF_EXTRA_ARGS = (
+    "--lua-filter=mermaid_filter.lua",
+    "--pdf-engine=xelatex",
+    "-V",
+    "mainfont=Noto Sans CJK SC",
+    "--highlight-style=pygments",
+)
+DOCX_EXTRA_ARGS = (
+    "--lua-filter=mermaid_filter.lua",
+    "--highlight-style=pygments",
+    "--reference-doc=reference.docx",
+)
+
+# mermaid_filter.lua 在图表未能渲染、保留原代码块时写到 stderr 的标记
+MERMAID_UNRENDERED_WARNING = "[mermaid_filter] diagram not rendered"
+
+EXPORT_MIMETYPES = {
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pdf": "application/pdf",
+}
+
+
+def _default_tmpdir():
+    tmpdir = os.environ.get("MD2DOCX_TMPDIR")
+    if tmpdir:
+        return tmpdir
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
+# 临时文件（pdf 输出、xelatex 中间文件、mermaid 图表）放在 tmpfs 上，
+# 它们很快就会被删除，没必要写入磁盘；可通过 MD2DOCX_TMPDIR 指定目录
+TMPDIR = _default_tmpdir()
+if TMPDIR:
+    tempfile.tempdir = TMPDIR
+# pandoc 及其调用的 xelatex、mmdc 通过 TMPDIR 环境变量选择临时目录
+_pandoc_env = dict(os.environ, TMPDIR=TMPDIR) if TMPDIR else None
+
+# 导出任务在有界线程池中执行：pandoc/xelatex 子进程运行时不占用 GIL。
+# 线程池小于每个 worker 的请求线程数（gunicorn --threads 4），
+# 才能真正限制每个 worker 同时运行的 pandoc 进程数量；可通过 MD2DOCX_EXPORT_WORKERS 调整
+EXPORT_MAX_WORKERS = int(os.environ.get("MD2DOCX_EXPORT_WORKERS", "2"))
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS, thread_name_prefix="export")
+
+# 常驻 pandoc server（pandoc >= 3.0），docx 导出不必每次都启动一个 pandoc 进程。
+# 设置 PANDOC_SERVER_URL 可以使用外部的 server；否则首次导出时在本机启动一个。
+PANDOC_SERVER_URL = os.environ.get("PANDOC_SERVER_URL", "")
+PANDOC_SERVER_TIMEOUT = 120
+_pandoc_server = {"url": PANDOC_SERVER_URL or None, "started": bool(PANDOC_SERVER_URL), "proc": None}
+_pandoc_server_lock = threading.Lock()
+# reference.docx 的 base64 内容，文件修改后（按 mtime 和大小判断）重新读取
+_reference_docx = {"stat": None, "b64": None}
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_pandoc_server():
+    """
+    启动 `pandoc server` 并等待端口可用，失败时返回 None（例如 pandoc 版本过旧）。
+    """
+    port = _free_port()
+    try:
+        proc = subprocess.Popen(
+            ["pandoc", "server", "--port", str(port), "--timeout", str(PANDOC_SERVER_TIMEOUT)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return None
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return None
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                break
+        except OSError:
+            time.sleep(0.05)
+    else:
+        proc.terminate()
+        return None
+
+    _pandoc_server["proc"] = proc
+    atexit.register(proc.terminate)
+    return f"http://127.0.0.1:{port}"
+
+
+def get_pandoc_server_url():
+    """
+    返回可用的 pandoc server 地址，只在第一次调用时尝试启动；不可用时返回 None。
+    """
+    with _pandoc_server_lock:
+        if not _pandoc_server["started"]:
+            _pandoc_server["started"] = True
+            _pandoc_server["url"] = _start_pandoc_server()
+        return _pandoc_server["url"]
+
+
+def convert_docx_via_server(server_url, md_text, input_format):
+    """
+    通过 pandoc server 将 Markdown 转为 docx，返回文件内容。
+    """
+    st = os.stat("reference.docx")
+    if _reference_docx["stat"] != (st.st_mtime_ns, st.st_size):
+        with open("reference.docx", "rb") as f:
+            _reference_docx["b64"] = base64.b64encode(f.read()).decode("ascii")
+        _reference_docx["stat"] = (st.st_mtime_ns, st.st_size)
+
+    resp = requests.post(
+        server_url,
+        json={
+            "text": md_text,
+            "from": input_format,
+            "to": "docx",
+            "standalone": True,
+            "highlight-style": "pygments",
+            "reference-doc": "reference.docx",
+            # server 没有文件系统访问权限，参考文档需要随请求一起提供
+            "files": {"reference.docx": _reference_docx["b64"]},
+        },
+        headers={"Accept": "application/octet-stream"},
+        timeout=PANDOC_SERVER_TIMEOUT,
+    )
+    resp.raise_for_status()
+    return resp.content
+
+
+def _iter_file_and_remove(path):
+    try:
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(PANDOC_CHUNK_SIZE), b"")
+    finally:
+        os.remove(path)
+
+
+def _iter_open_file(f):
+    with f:
+        yield from iter(lambda: f.read(PANDOC_CHUNK_SIZE), b"")
+
+
+def run_pandoc(md_text, to, input_format, extra_args):
+    """
+    通过 stdin 把 Markdown 交给 pandoc，不再落地临时 .md 文件。
+    docx 较小，直接从 stdout 完整读出并返回 bytes；pdf 只能由 .pdf 扩展名触发，
+    仍需写到临时文件，返回其内容的迭代器。两种情况都等 pandoc 退出后才返回，
+    线程池的名额在此之前不会释放。返回 (输出内容, pandoc 的 stderr 文本)，
+    转换失败时抛出 RuntimeError。
+    """
+    if to == "pdf":
+        fd, output_file = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+    else:
+        output_file = "-"
+
+    proc = subprocess.Popen(
+        ["pandoc", "-f", input_format, "-t", to, *extra_args, "-o", output_file],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=_pandoc_env,
+    )
+    # 后台读取 stderr，避免警告信息写满管道导致 pandoc 阻塞
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    try:
+        proc.stdin.write(md_text.encode("utf-8"))
+    except BrokenPipeError:
+        pass
+    finally:
+        proc.stdin.close()
+
+    output = proc.stdout.read()
+    proc.stdout.close()
+    proc.wait()
+    stderr_reader.join()
+    proc.stderr.close()
+    message = b"".join(stderr_chunks).decode("utf-8", errors="replace").strip()
+    if proc.returncode == 0:
+        if output_file == "-":
+            return output, message
+        return _iter_file_and_remove(output_file), message
+
+    if output_file != "-":
+        os.remove(output_file)
+    raise RuntimeError(message or f"pandoc exited with code {proc.returncode}")
+
+
+# 导出结果缓存：小文件放内存 LRU，所有结果都写入磁盘缓存目录，按 atime 淘汰
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", "export_cache")
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+EXPORT_MEMORY_CACHE_SIZE = 64
+EXPORT_MEMORY_ITEM_MAX_BYTES = 1024 * 1024
+_export_memory_cache = LRUCache(EXPORT_MEMORY_CACHE_SIZE)
+_export_cache_lock = threading.Lock()
+
+
+def _export_cache_path(key, export_type):
+    return os.path.join(EXPORT_CACHE_DIR, f"{key}.{export_type}")
+
+
+def _export_inputs_stamp():
+    """
+    参考文档和 mermaid 过滤器的 mtime 与大小，计入缓存键：
+    它们修改后，旧的导出结果不再命中，由 atime 淘汰。
+    """
+    parts = []
+    for path in ("reference.docx", "mermaid_filter.lua"):
+        try:
+            st = os.stat(path)
+        except OSError:
+            parts.append("-")
+        else:
+            parts.append(f"{st.st_mtime_ns}:{st.st_size}")
+    return ",".join(parts)
+
+
+def get_cached_export(key, export_type):
+    """
+    查找已缓存的导出结果，命中时返回 bytes 或文件内容的迭代器，否则返回 None。
+    """
+    body = _export_memory_cache.get(key)
+    if body is not None:
+        return body
+
+    path = _export_cache_path(key, export_type)
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    # 显式更新 atime，挂载了 relatime/noatime 时读取不会更新它
+    try:
+        os.utime(path, (time.time(), os.fstat(f.fileno()).st_mtime))
+    except OSError:
+        pass
+    return _iter_open_file(f)
+
+
+def _evict_export_cache():
+    with _export_cache_lock:
+        entries = []
+        total = 0
+        with os.scandir(EXPORT_CACHE_DIR) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_atime, st.st_size, entry.path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= EXPORT_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def _store_export(key, export_type, chunks):
+    """
+    把导出结果写入磁盘缓存：先写同目录下的临时文件，完成后原子地 rename 到位。
+    """
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, suffix=".tmp")
+    size = 0
+    small = []
+    try:
+        try:
+            # 直接 os.write 到 fd：数据已是 64 KiB 的块，不需要再经过 io 层的缓冲
+            for chunk in chunks:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view) :]
+                size += len(chunk)
+                if size <= EXPORT_MEMORY_ITEM_MAX_BYTES:
+                    small.append(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, _export_cache_path(key, export_type))
+    except BaseException:
+        # 客户端中途断开或 pandoc 出错时不留下不完整的缓存
+        os.remove(tmp_path)
+        raise
+
+    if size <= EXPORT_MEMORY_ITEM_MAX_BYTES:
+        _export_memory_cache.put(key, b"".join(small))
+    _evict_export_cache()
+
+
+def cache_export(key, export_type, body):
+    """
+    缓存刚生成的导出结果，返回用于响应的内容；流式输出的结果边发送边写入缓存。
+    """
+    if isinstance(body, bytes):
+        for _ in _store_export(key, export_type, [body]):
+            pass
+        return body
+    return _store_export(key, export_type, body)
+
 
 @bp.route("/preview", methods=["POST"])
 def preview():
@@ -18,24 +545,33 @@ def preview():
     """
     md_text = request.form.get("markdown_input", "")
 
-    # 保证 \[...\] 公式的前后有空行
-    md_text = re.sub(r"([^\n])(\s*)\\\[(.*?)\\\]([^\n])", r"\1\n\n\\[\3\\]\n\n\4", md_text, flags=re.DOTALL)
-    md_text = re.sub(r"^(\s*)\\\[(.*?)\\\](\s*)(?=\n|$)", r"\n\\[\2\\]\n", md_text, flags=re.MULTILINE | re.DOTALL)
+    # 内容未变化时直接返回 304，前端无需重新渲染
+    key = content_digest(md_text)
+    if request.if_none_match.contains(key):
+        resp = Response(status=304)
+    else:
+        # 缓存编码后的 UTF-8 字节，命中时无需再次编码
+        body = _preview_cache.get(key)
+        if body is None:
+            body = render_preview(md_text).encode("utf-8")
+            _preview_cache.put(key, body)
+        resp = Response(body, content_type="text/html; charset=utf-8")
+
+    resp.set_etag(key)
+    resp.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return resp
 
-    # Markdown 转 HTML
-    html = markdown.markdown(
-        md_text,
-        extensions=["fenced_code", "codehilite", "tables", "nl2br", "pymdownx.arithmatex"],
-        extension_configs={
-            "codehilite": {
-                "linenums": False,
-                "guess_lang": False,
-            },
-            "pymdownx.arithmatex": {"generic": True, "preview": False},
-        },
-    )
 
-    return html
+def render_preview(md_text):
+    """
+    预处理 Markdown 并渲染为 HTML。
+    """
+    # 保证 \[...\] 公式的前后有空行；没有 \[ 的纯文本直接跳过正则扫描
+    if "\\[" in md_text:
+        md_text = pad_block_math(md_text)
+
+    # Markdown 转 HTML
+    return _markdown.render(md_text)
 
 
 @bp.route("/convert", methods=["POST"])
@@ -48,21 +584,19 @@ def convert():
     if not md_text:
         return jsonify({"error": "markdown_input 不能为空"}), 400
 
-    input_format = "markdown+raw_tex+tex_math_dollars+tex_math_double_backslash"
-
     try:
         # 转换为 LaTeX
         latex_output = pypandoc.convert_text(
             md_text,
             "latex",
-            format=input_format,
+            format=PANDOC_INPUT_FORMAT,
         )
 
         # 转换为 HTML（包含 MathML）
         mathml_output = pypandoc.convert_text(
             md_text,
             "html",
-            format=input_format,
+            format=PANDOC_INPUT_FORMAT,
             extra_args=["--mathml"],
         )
 
@@ -84,56 +618,53 @@ def export():
     """
     md_text = request.form.get("markdown_input", "")
     export_type = request.args.get("type", "docx")
+    if export_type not in EXPORT_MIMETYPES:
+        return "未知的导出类型", 400
 
-    # 替换 \[1mm] => \vspace{1mm}
-    md_text = re.sub(r"\\\[1mm\]", r"\\vspace{1mm}", md_text)
+    # 先用子串探测（str 的 in 基于 memchr，开销远小于正则扫描），
+    # 不含公式或代码块的纯文本跳过对应的正则处理
+    has_bracket = "\\[" in md_text
+    has_paren = "\\(" in md_text
+    has_fence = "```" in md_text or "~~~" in md_text
 
-    # 同样为 \[...\] 公式加空行
-    md_text = re.sub(r"([^\n])(\s*)\\\[(.*?)\\\]([^\n])", r"\1\n\n\\[\3\\]\n\n\4", md_text, flags=re.DOTALL)
-    md_text = re.sub(r"^(\s*)\\\[(.*?)\\\](\s*)(?=\n|$)", r"\n\\[\2\\]\n", md_text, flags=re.MULTILINE | re.DOTALL)
+    cleaned_md = md_text
+    if has_bracket:
+        # 替换 \[1mm] => \vspace{1mm}
+        cleaned_md = _RE_VSPACE_1MM.sub(r"\\vspace{1mm}", cleaned_md)
 
-    # 保留原始LaTeX公式，不做额外处理
-    cleaned_md = re.sub(r'<span class="arithmatex">(.*?)</span>', r"\1", md_text)
-    # 将行级公式由 \( \) => $ $
-    cleaned_md = re.sub(r"\\\(", r"$", cleaned_md)
-    cleaned_md = re.sub(r"\\\)", r"$", cleaned_md)
-    # 将块级公式 \[ \] => $$ $$
-    cleaned_md = re.sub(r"\\\[", r"$$", cleaned_md)
-    cleaned_md = re.sub(r"\\\]", r"$$", cleaned_md)
+        # 同样为 \[...\] 公式加空行
+        cleaned_md = pad_block_math(cleaned_md)
+
+    # 将行级公式由 \( \) => $ $，块级公式 \[ \] => $$ $$
+    if has_bracket or has_paren or "\\]" in cleaned_md or "\\)" in cleaned_md:
+        cleaned_md = _RE_MATH_DELIM.sub(lambda m: _MATH_DELIM_MAP[m.group(0)], cleaned_md)
 
     # 处理 $ formula $ => $formula$ (去除$与公式之间的空格)
-    # 使用负向断言避免匹配 $$ 块级公式
-    cleaned_md = re.sub(r"(?<!\$)\$ +(.+?) +\$(?!\$)", r"$\1$", cleaned_md)
+    cleaned_md = strip_inline_math_spaces(cleaned_md)
+
+    # 以下 LaTeX 环境的改写都需要 \begin{...} 或 \left\{ / \right\}
+    has_env = "\\begin{" in cleaned_md
+    has_brace = "\\left\\{" in cleaned_md or "\\right\\}" in cleaned_md
 
     # 将矩阵环境转换为 \left...\right 形式，解决 Word 中竖线太短的问题
     # vmatrix -> \left| \begin{matrix}...\end{matrix} \right|
-    cleaned_md = re.sub(
-        r"\\begin\{vmatrix\}(.*?)\\end\{vmatrix\}",
-        r"\\left| \\begin{matrix}\1\\end{matrix} \\right|",
-        cleaned_md,
-        flags=re.DOTALL,
-    )
     # Vmatrix -> \left\| \begin{matrix}...\end{matrix} \right\|
-    cleaned_md = re.sub(
-        r"\\begin\{Vmatrix\}(.*?)\\end\{Vmatrix\}",
-        r"\\left\\| \\begin{matrix}\1\\end{matrix} \\right\\|",
-        cleaned_md,
-        flags=re.DOTALL,
-    )
+    def convert_vmatrix(match):
+        # 一次扫描不会进入已匹配的内容，嵌套的矩阵在这里递归处理
+        content = _RE_VMATRIX.sub(convert_vmatrix, match.group(2))
+        bar = "|" if match.group(1) == "v" else r"\|"
+        return r"\left" + bar + r" \begin{matrix}" + content + r"\end{matrix} \right" + bar
+
+    if has_env:
+        cleaned_md = _RE_VMATRIX.sub(convert_vmatrix, cleaned_md)
 
     # 修复大括号方程组间距问题：去除 \left\{ 后面的空白并插入负向空格 \!
-    # 这样可以让 Word(OMML) 中大括号与后续内容紧凑对齐
-    cleaned_md = re.sub(
-        r"\\left\\\{\s+",
-        r"\\left\\{\\!",
-        cleaned_md,
-    )
-    # 同样处理 \right\} 前面的空白
-    cleaned_md = re.sub(
-        r"\s+\\right\\\}",
-        r"\\!\\right\\}",
-        cleaned_md,
-    )
+    # 这样可以让 Word(OMML) 中大括号与后续内容紧凑对齐；同样处理 \right\} 前面的空白
+    if has_brace:
+        cleaned_md = _RE_BRACE_SPACE.sub(
+            lambda m: r"\left\{\!" if m.group(0).startswith("\\") else r"\!\right\}",
+            cleaned_md,
+        )
 
     # 处理 cases 环境：Pandoc 对 cases 的处理有时也会有间距问题
     # 将 cases 转换为 \left\{ \begin{array}{ll}...\end{array} \right. 形式
@@ -142,92 +673,68 @@ def export():
         # 将 & 分隔的项保持不变，\\ 换行保持不变
         return r"\left\{\begin{array}{ll}" + content + r"\end{array}\right."
 
-    cleaned_md = re.sub(
-        r"\\begin\{cases\}(.*?)\\end\{cases\}",
-        convert_cases,
-        cleaned_md,
-        flags=re.DOTALL,
-    )
+    if has_env:
+        cleaned_md = _RE_CASES.sub(convert_cases, cleaned_md)
 
     # 处理 aligned 环境：将 \left\{\begin{aligned}...\end{aligned}\right. 转换为 array 格式
     # aligned 环境在 Word(OMML) 中渲染不稳定，array 更可靠
+    # 也处理独立的 aligned 环境（不在 \left\{ 中的）
     def convert_aligned_to_array(match):
-        content = match.group(1)
+        braced = match.group("braced")
+        content = braced if braced is not None else match.group("plain")
         # aligned 中每行开头的 & 是对齐标记，在 array{l} 中不需要
         # 去掉每行开头的 &（可能前面有空白）
-        content = re.sub(r"(^|\\\\)\s*&", r"\1", content)
-        return r"\left\{\begin{array}{l}" + content + r"\end{array}\right."
-
-    cleaned_md = re.sub(
-        r"\\left\\\{\\begin\{aligned\}(.*?)\\end\{aligned\}\\right\.",
-        convert_aligned_to_array,
-        cleaned_md,
-        flags=re.DOTALL,
-    )
-
-    # 也处理独立的 aligned 环境（不在 \left\{ 中的）
-    def convert_standalone_aligned(match):
-        content = match.group(1)
-        content = re.sub(r"(^|\\\\)\s*&", r"\1", content)
+        content = _RE_ALIGN_MARK.sub(r"\1", content)
+        if braced is not None:
+            return r"\left\{\begin{array}{l}" + content + r"\end{array}\right."
         return r"\begin{array}{l}" + content + r"\end{array}"
 
-    cleaned_md = re.sub(
-        r"\\begin\{aligned\}(.*?)\\end\{aligned\}",
-        convert_standalone_aligned,
-        cleaned_md,
-        flags=re.DOTALL,
+    if has_env:
+        cleaned_md = _RE_ALIGNED.sub(convert_aligned_to_array, cleaned_md)
+
+    # 相同内容、相同类型的导出直接使用缓存，不再调用 pandoc/xelatex
+    cache_key = content_digest(export_type + "\0" + _export_inputs_stamp() + "\0" + cleaned_md)
+    body = get_cached_export(cache_key, export_type)
+    if body is None:
+        warnings = ""
+        try:
+            if export_type == "docx":
+                body = None
+                # pandoc server 不能执行 Lua 过滤器，也不能读取文件或下载图片，
+                # 含 mermaid 图表或图片时改用命令行 pandoc
+                needs_cli = (has_fence and _RE_MERMAID.search(cleaned_md)) or _RE_IMAGE.search(cleaned_md)
+                server_url = None if needs_cli else get_pandoc_server_url()
+                if server_url:
+                    try:
+                        body = _export_executor.submit(convert_docx_via_server, server_url, cleaned_md, PANDOC_INPUT_FORMAT).result()
+                    except requests.RequestException:
+                        # server 出错时回退到命令行 pandoc
+                        body = None
+
+                if body is None:
+                    body, warnings = _export_executor.submit(run_pandoc, cleaned_md, "docx", PANDOC_INPUT_FORMAT, DOCX_EXTRA_ARGS).result()
+
+            else:
+                body, warnings = _export_executor.submit(run_pandoc, cleaned_md, "pdf", PANDOC_INPUT_FORMAT, PDF_EXTRA_ARGS).result()
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+        # 有 mermaid 图表未能渲染时结果不完整，不写入缓存，安装 mmdc 后重新导出即可得到图表
+        if MERMAID_UNRENDERED_WARNING not in warnings:
+            body = cache_export(cache_key, export_type, body)
+
+    return Response(
+        body,
+        mimetype=EXPORT_MIMETYPES[export_type],
+        headers={"Content-Disposition": f"attachment; filename=output.{export_type}"},
     )
 
-    with tempfile.NamedTemporaryFile(suffix=".md", delete=False) as f_in:
-        f_in.write(cleaned_md.encode("utf-8"))
-        md_path = f_in.name
-
-    output_file = md_path + "." + export_type
-
-    # 增加 +raw_tex+tex_math_double_backslash
-    # 移除 --mathml，减少对LaTeX命令的干扰
-    # Explicitly define input format with extensions
-    input_format = "markdown+raw_tex+tex_math_dollars+tex_math_double_backslash"
-
-    extra_args_for_pdf = [
-        "--pdf-engine=xelatex",
-        "-V",
-        "mainfont=Noto Sans CJK SC",
-        "--highlight-style=pygments",
-    ]
-    extra_args_for_docx = [
-        "--highlight-style=pygments",
-        "--reference-doc=reference.docx",
-    ]
-
-    try:
-        if export_type == "docx":
-            pypandoc.convert_file(md_path, "docx", format=input_format, outputfile=output_file, extra_args=extra_args_for_docx)
-            resp = make_response(send_file(output_file, as_attachment=True, download_name="output.docx"))
-            resp.headers["Content-Type"] = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-
-        elif export_type == "pdf":
-            pypandoc.convert_file(md_path, "pdf", format=input_format, outputfile=output_file, extra_args=extra_args_for_pdf)
-            resp = make_response(send_file(output_file, as_attachment=True, download_name="output.pdf"))
-            resp.headers["Content-Type"] = "application/pdf"
-
-        else:
-            os.remove(md_path)
-            return "未知的导出类型", 400
-
-    except Exception as e:
-        os.remove(md_path)
-        if os.path.exists(output_file):
-            os.remove(output_file)
-        return jsonify({"error": str(e)}), 500
-
-    os.remove(md_path)
-    return resp
-
 
 # 注册 Blueprint
 app.register_blueprint(bp)
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=8055)
+    # 开发环境使用；生产环境请使用 gunicorn（见 Dockerfile）
+    app.run(port=8055, threaded=True)
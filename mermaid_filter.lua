@@ -3,33 +3,172 @@
 --[[
   当 Pandoc 处理 Markdown 时，如检测到 CodeBlock 的 classes 含 "mermaid"/"sequence"/"flowchart"，
   则调用 mermaid-cli 生成对应 PNG 图片，并把该 CodeBlock 替换为嵌入图片。
+
+  同一文档中的所有图表会写入一个 Markdown 文件，只调用一次 mmdc，
+  避免每个图表都启动一次 Node.js + Chromium；批量渲染中断时，缺失的图表再逐个渲染。
+  生成的图片按代码的 SHA1 缓存在 MERMAID_CACHE_DIR（默认 mermaid_cache）下，
+  未修改的图表不会再次调用 mmdc。
+
+  如果设置了 MERMAID_SERVER_URL（见 mermaid_server.js），则向常驻的渲染服务请求图片，
+  复用同一个 Chromium 实例，不再启动 mmdc；服务不可用时回退到 mmdc。
 --]]
 
-function CodeBlock(block)
+local MERMAID_CLASSES = { mermaid = true, sequence = true, flowchart = true }
+local CACHE_DIR = os.getenv('MERMAID_CACHE_DIR') or 'mermaid_cache'
+local SERVER_URL = os.getenv('MERMAID_SERVER_URL')
+
+local missing = {}
+local pending = {}
+
+local function is_mermaid(block)
     for _, class in pairs(block.classes) do
-        if class == 'mermaid' or class == 'sequence' or class == 'flowchart' then
-            -- 生成一个随机文件名，避免多用户/多并发时冲突
-            local os = require 'os'
-            math.randomseed(os.time())
-            local r = math.random(1000000000)
-            local input_file  = 'temp_' .. r .. '.mmd'
-            local output_file = 'temp_' .. r .. '.png'
-
-            -- 将 mermaid 代码写入临时 .mmd
-            local f = io.open(input_file, 'w')
-            f:write(block.text)
-            f:close()
-
-            -- 调用 mermaid-cli (mmdc) 生成 PNG
-            os.execute('mmdc -i ' .. input_file .. ' -o ' .. output_file)
-
-            -- 删除临时 .mmd
-            os.remove(input_file)
-
-            -- 用一段包含图片的段落替换原代码块
+        if MERMAID_CLASSES[class] then
+            return true
+        end
+    end
+    return false
+end
+
+local function cache_path(code)
+    return CACHE_DIR .. '/' .. pandoc.utils.sha1(code) .. '.png'
+end
+
+local function file_exists(path)
+    local f = io.open(path, 'rb')
+    if f then
+        f:close()
+        return true
+    end
+    return false
+end
+
+-- 先写临时文件再 rename，避免并发请求读到写了一半的图片；
+-- 临时文件放在缓存目录下每次唯一的子目录中，并发的 pandoc 进程不会写同一个文件
+local function write_file(dst, data)
+    pandoc.system.with_temporary_directory(CACHE_DIR, 'write', function(tmpdir)
+        local tmp = tmpdir .. '/diagram.png'
+        local out = io.open(tmp, 'wb')
+        out:write(data)
+        out:close()
+        os.rename(tmp, dst)
+    end)
+end
+
+local function copy_file(src, dst)
+    local f = io.open(src, 'rb')
+    if not f then
+        return
+    end
+    local data = f:read('a')
+    f:close()
+    write_file(dst, data)
+end
+
+local function url_encode(s)
+    return (s:gsub('[^%w%-_%.~]', function(c)
+        return string.format('%%%02X', string.byte(c))
+    end))
+end
+
+-- 第一遍：按文档顺序收集尚未缓存的 mermaid 代码
+local function collect(block)
+    if is_mermaid(block) then
+        local path = cache_path(block.text)
+        if not pending[path] and not file_exists(path) then
+            pending[path] = true
+            table.insert(missing, { code = block.text, path = path })
+        end
+    end
+end
+
+-- 通过常驻渲染服务生成图片，返回渲染失败的图表
+local function render_with_server(items)
+    local failed = {}
+    for _, item in ipairs(items) do
+        -- fetch 不会因非 2xx 响应报错，渲染失败时返回的是 text/plain 错误信息，
+        -- 必须检查 mime 类型，否则错误信息会被当作图片写入缓存
+        local ok, mime, contents = pcall(pandoc.mediabag.fetch, SERVER_URL .. '/render?code=' .. url_encode(item.code))
+        if ok and contents and mime and mime:match('^image/png') then
+            write_file(item.path, contents)
+        else
+            table.insert(failed, item)
+        end
+    end
+    return failed
+end
+
+-- 调用 mermaid-cli (mmdc) 生成 PNG；其输出重定向到 stderr，
+-- 避免混入 pandoc 写到 stdout 的文档内容
+local function run_mmdc(input_file, output_file)
+    os.execute('mmdc -i "' .. input_file .. '" -o "' .. output_file .. '" -e png 1>&2')
+end
+
+-- 在每个文档独立的临时目录中调用一次 mmdc 渲染所有图表
+local function render_with_mmdc(items)
+    pandoc.system.with_temporary_directory('mermaid', function(tmpdir)
+        local input_file  = tmpdir .. '/diagrams.md'
+        local output_file = tmpdir .. '/out.md'
+
+        -- 将所有 mermaid 代码写入同一个 .md，mmdc 会为每个代码块生成 out-<n>.png
+        local f = io.open(input_file, 'w')
+        for _, item in ipairs(items) do
+            f:write('```mermaid\n', item.code, '\n```\n\n')
+        end
+        f:close()
+
+        run_mmdc(input_file, output_file)
+
+        for i, item in ipairs(items) do
+            local png = tmpdir .. '/out-' .. i .. '.png'
+            if not file_exists(png) then
+                -- 某个图表有语法错误时 mmdc 会中止，之后的图表都没有输出，
+                -- 这些图表逐个单独渲染，互不影响
+                local single = tmpdir .. '/diagram-' .. i .. '.mmd'
+                local out = io.open(single, 'w')
+                out:write(item.code)
+                out:close()
+                run_mmdc(single, png)
+            end
+            copy_file(png, item.path)
+        end
+    end)
+end
+
+-- 渲染所有未缓存的图表
+local function render_missing(doc)
+    if #missing == 0 then
+        return nil
+    end
+
+    os.execute('mkdir -p "' .. CACHE_DIR .. '"')
+
+    local rest = missing
+    if SERVER_URL then
+        rest = render_with_server(missing)
+    end
+    if #rest > 0 then
+        render_with_mmdc(rest)
+    end
+    return nil
+end
+
+-- 第二遍：用一段包含图片的段落替换原代码块；
+-- 没有生成图片（如未安装 mmdc 或图表有语法错误）时保留原代码块，
+-- 并在 stderr 输出标记，app.py 据此不缓存这次不完整的导出结果
+local function replace(block)
+    if is_mermaid(block) then
+        local path = cache_path(block.text)
+        if file_exists(path) then
             return pandoc.Para({
-                pandoc.Image({ pandoc.Str("diagram") }, output_file)
+                pandoc.Image({ pandoc.Str("diagram") }, path)
             })
         end
+        io.stderr:write('[mermaid_filter] diagram not rendered\n')
     end
 end
+
+return {
+    { CodeBlock = collect },
+    { Pandoc = render_missing },
+    { CodeBlock = replace },
+}
@@ -0,0 +1,53 @@
+// mermaid_server.js
+//
+// 常驻的 mermaid 渲染服务：启动时打开一个 Chromium，之后所有图表都复用它，
+// 避免每次调用 mmdc 都冷启动 Node.js + Chromium。
+//
+// 安装依赖：npm install @mermaid-js/mermaid-cli puppeteer
+// 启动服务：node mermaid_server.js（默认监听 127.0.0.1:3031）
+// 启用方式：为 Flask 应用设置 MERMAID_SERVER_URL=http://127.0.0.1:3031，
+//           mermaid_filter.lua 会通过 GET /render?code=<mermaid 代码> 获取 PNG
+
+const http = require('http');
+const puppeteer = require('puppeteer');
+
+const HOST = process.env.MERMAID_SERVER_HOST || '127.0.0.1';
+const PORT = Number(process.env.MERMAID_SERVER_PORT || 3031);
+
+async function main() {
+    // mermaid-cli 是 ES module，只能通过动态 import 加载
+    const { renderMermaid } = await import('@mermaid-js/mermaid-cli');
+    const browser = await puppeteer.launch({ headless: true, args: ['--no-sandbox'] });
+
+    const server = http.createServer(async (req, res) => {
+        const url = new URL(req.url, 'http://localhost');
+        if (req.method !== 'GET' || url.pathname !== '/render') {
+            res.writeHead(404).end();
+            return;
+        }
+
+        try {
+            const { data } = await renderMermaid(browser, url.searchParams.get('code') || '', 'png');
+            res.writeHead(200, { 'Content-Type': 'image/png' }).end(Buffer.from(data));
+        } catch (err) {
+            res.writeHead(400, { 'Content-Type': 'text/plain; charset=utf-8' }).end(String(err));
+        }
+    });
+
+    const shutdown = async () => {
+        server.close();
+        await browser.close();
+        process.exit(0);
+    };
+    process.on('SIGINT', shutdown);
+    process.on('SIGTERM', shutdown);
+
+    server.listen(PORT, HOST, () => {
+        console.log(`mermaid server listening on http://${HOST}:${PORT}`);
+    });
+}
+
+main().catch((err) => {
+    console.error(err);
+    process.exit(1);
+});
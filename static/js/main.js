@@ -57,23 +57,35 @@ document.getElementById('preview_btn').addEventListener('click', async () => {
     }
 });
 
+// 上一次预览结果的 ETag，内容未变化时服务端返回 304
+let previewEtag = null;
+
 // 更新预览内容
 async function updatePreview() {
     try {
         const mdText = textarea.value;
+        const headers = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        };
+        if (previewEtag) {
+            headers['If-None-Match'] = previewEtag;
+        }
         
         const response = await fetch('/preview', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/x-www-form-urlencoded'
-            },
+            headers: headers,
             body: new URLSearchParams({ markdown_input: mdText })
         });
         
+        // 内容未变化，保留当前预览
+        if (response.status === 304) {
+            return;
+        }
         if (!response.ok) {
             throw new Error("预览请求失败: " + response.statusText);
         }
         
+        previewEtag = response.headers.get('ETag');
         const html = await response.text();
         previewContent.innerHTML = html;
         
@@ -0,0 +1,217 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import app
+from app import LRUCache, pad_block_math, render_preview, strip_inline_math_spaces
+
+# 代替 pandoc 的脚本：输出 "OUT:" + 输入内容，输入含 FAIL 时失败，
+# 含 mermaid 代码块时像未安装 mmdc 的 mermaid_filter.lua 一样在 stderr 输出标记
+FAKE_PANDOC = r"""
+import sys
+args = sys.argv[1:]
+data = sys.stdin.buffer.read()
+if b"FAIL" in data:
+    sys.stderr.write("boom")
+    sys.exit(1)
+if b"```mermaid" in data:
+    sys.stderr.write("[mermaid_filter] diagram not rendered\n")
+out = args[args.index("-o") + 1]
+if out == "-":
+    sys.stdout.buffer.write(b"OUT:" + data)
+else:
+    with open(out, "wb") as f:
+        f.write(b"OUT:" + data)
+"""
+
+
+class PadBlockMathTest(unittest.TestCase):
+    def test_row_spacing_inside_block_math(self):
+        md = "\\[\n\\begin{aligned} a &= b \\\\[2pt] c \\end{aligned}\n\\]\n"
+        self.assertEqual(pad_block_math(md), "\n" + md + "\n")
+
+    def test_row_spacing_preview(self):
+        md = "\\[\n\\begin{aligned} a &= b \\\\[1mm] c \\end{aligned}\n\\]\n"
+        html = render_preview(md)
+        self.assertEqual(html.count('<div class="arithmatex">'), 1)
+        self.assertIn("b \\\\[1mm] c", html)
+
+    def test_inline_block_math_is_split_out(self):
+        self.assertEqual(pad_block_math("x \\[a\\] y\n"), "x\n\n\\[a\\]\n\ny\n")
+
+
+class StripInlineMathSpacesTest(unittest.TestCase):
+    def test_strips_spaces(self):
+        self.assertEqual(strip_inline_math_spaces("a $ x + y $ b"), "a $x + y$ b")
+
+    def test_keeps_unpadded_math(self):
+        for text in ("$x$", "$ x$", "$x $", "$  $"):
+            self.assertEqual(strip_inline_math_spaces(text), text)
+
+    def test_skips_display_math(self):
+        text = "$$ x $$ and $ y $"
+        self.assertEqual(strip_inline_math_spaces(text), "$$ x $$ and $y$")
+
+    def test_unclosed_display_math_is_literal(self):
+        self.assertEqual(strip_inline_math_spaces("$$ unclosed then $ y $"), "$$ unclosed then $y$")
+
+    def test_inline_math_does_not_span_lines(self):
+        self.assertEqual(strip_inline_math_spaces("$ a\n b $"), "$ a\n b $")
+        # 与原正则一致：跨行的 $ 不成对，换行后的 $ 作为新的起点
+        self.assertEqual(strip_inline_math_spaces("$ a\n $ b $"), "$ a\n $b$")
+
+    def test_multiple_formulas(self):
+        self.assertEqual(strip_inline_math_spaces("$ a $, $ b $ and $c$"), "$a$, $b$ and $c$")
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_by_count(self):
+        cache = LRUCache(2)
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.get("a")
+        cache.put("c", b"3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1")
+
+    def test_evicts_by_total_bytes(self):
+        cache = LRUCache(10, maxbytes=10)
+        cache.put("a", b"x" * 6)
+        cache.put("b", b"x" * 6)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), b"x" * 6)
+
+    def test_skips_values_over_limit(self):
+        cache = LRUCache(10, maxbytes=10)
+        cache.put("a", b"x" * 4)
+        cache.put("b", b"x" * 11)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"x" * 4)
+
+
+class ExportCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.pandoc_calls = []
+        real_popen = subprocess.Popen
+
+        def fake_popen(args, **kwargs):
+            self.pandoc_calls.append(args)
+            return real_popen([sys.executable, "-c", FAKE_PANDOC, *args[1:]], **kwargs)
+
+        for target, value in (
+            ("EXPORT_CACHE_DIR", self.cache_dir),
+            ("_export_memory_cache", LRUCache(app.EXPORT_MEMORY_CACHE_SIZE)),
+            ("get_pandoc_server_url", lambda: None),
+        ):
+            patcher = mock.patch.object(app, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app.subprocess, "Popen", fake_popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def export(self, md_text, export_type="docx"):
+        return self.client.post(f"/doc_converter/v1/export?type={export_type}", data={"markdown_input": md_text})
+
+    def cached_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_docx_is_cached(self):
+        first = self.export("hello")
+        second = self.export("hello")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data, b"OUT:hello")
+        self.assertEqual(second.data, b"OUT:hello")
+        self.assertEqual(len(self.pandoc_calls), 1)
+        files = self.cached_files()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(".docx"))
+
+    def test_pdf_is_streamed_into_cache(self):
+        self.assertEqual(self.export("hello", "pdf").data, b"OUT:hello")
+        app._export_memory_cache = LRUCache(app.EXPORT_MEMORY_CACHE_SIZE)
+        # 内存缓存为空时从磁盘读取
+        self.assertEqual(self.export("hello", "pdf").data, b"OUT:hello")
+        self.assertEqual(len(self.pandoc_calls), 1)
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_failed_export_is_not_cached(self):
+        resp = self.export("FAIL")
+        self.assertEqual(resp.status_code, 500)
+        self.assertIn("boom", resp.get_json()["error"])
+        self.assertEqual(self.cached_files(), [])
+
+    def test_unrendered_mermaid_is_not_cached(self):
+        md = "```mermaid\ngraph TD\n```\n"
+        self.assertEqual(self.export(md).status_code, 200)
+        self.assertEqual(self.export(md).status_code, 200)
+        self.assertEqual(len(self.pandoc_calls), 2)
+        self.assertEqual(self.cached_files(), [])
+
+    def test_inputs_change_invalidates_cache(self):
+        self.export("hello")
+        with mock.patch.object(app, "_export_inputs_stamp", lambda: "changed"):
+            self.export("hello")
+        self.assertEqual(len(self.pandoc_calls), 2)
+
+    def test_client_disconnect_removes_partial_file(self):
+        chunks = app._store_export("key", "pdf", iter([b"a", b"b"]))
+        next(chunks)
+        chunks.close()
+        self.assertEqual(self.cached_files(), [])
+
+    def test_pandoc_error_removes_partial_file(self):
+        def failing():
+            yield b"a"
+            raise RuntimeError("pandoc exited with code 1")
+
+        with self.assertRaises(RuntimeError):
+            list(app._store_export("key", "pdf", failing()))
+        self.assertEqual(self.cached_files(), [])
+
+    def test_evicts_least_recently_used(self):
+        for i, name in enumerate(("old.pdf", "mid.pdf", "new.pdf")):
+            path = os.path.join(self.cache_dir, name)
+            with open(path, "wb") as f:
+                f.write(b"x" * 10)
+            os.utime(path, (1000 + i, 1000 + i))
+        with mock.patch.object(app, "EXPORT_CACHE_MAX_BYTES", 20):
+            app._evict_export_cache()
+        self.assertEqual(self.cached_files(), ["mid.pdf", "new.pdf"])
+
+
+class PreviewTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def preview(self, md_text, etag=None):
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.client.post("/doc_converter/v1/preview", data={"markdown_input": md_text}, headers=headers)
+
+    def test_unchanged_content_returns_304(self):
+        first = self.preview("# title")
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("<h1>title</h1>", first.get_data(as_text=True))
+        etag = first.headers["ETag"]
+
+        second = self.preview("# title", etag)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.data, b"")
+        self.assertEqual(second.headers["ETag"], etag)
+
+    def test_changed_content_returns_200(self):
+        etag = self.preview("# title").headers["ETag"]
+        resp = self.preview("# other", etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+
+if __name__ == "__main__":
+    unittest.main()